@@ -6,21 +6,47 @@
 import os
 
 # os.environ["TRANSFORMERS_NO_META"] = "1"  # Disable if causing issues
-os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
+# Caching allocator tuned against fragmentation from mixed tile counts,
+# which is what usually triggers the max_num=12 -> 6 OOM fallback
+CUDA_ALLOC_CONF = (
+    "expandable_segments:True,"
+    "max_split_size_mb:512,"
+    "garbage_collection_threshold:0.8,"
+    "roundup_power2_divisions:8"
+)
+os.environ["PYTORCH_CUDA_ALLOC_CONF"] = CUDA_ALLOC_CONF
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 os.environ["CUDA_LAUNCH_BLOCKING"] = "0"
-os.environ["INTERNVL_USE_FLASH_ATTN"] = "0"
+# Resolved per-GPU in _from_pretrained() before the remote model code is imported
+os.environ.setdefault("INTERNVL_USE_FLASH_ATTN", "0")
 
 import gc
 import torch
-from transformers import AutoTokenizer, AutoModel, BitsAndBytesConfig
+from transformers import (
+    AutoTokenizer,
+    AutoModel,
+    BitsAndBytesConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
 from backend.prompts import METADATA_PROMPT, EXTRACTION_PROMPT
+from backend.schemas import json_schema_for
 from backend.utils import try_parse_json_strict
 
+try:
+    from lmformatenforcer import JsonSchemaParser
+    from lmformatenforcer.integrations.transformers import (
+        build_token_enforcer_tokenizer_data,
+        build_transformers_prefix_allowed_tokens_fn,
+    )
+except ImportError:
+    JsonSchemaParser = None
+
 
 MODEL_PATH = "OpenGVLab/InternVL2_5-4B-MPO"
 
-# ✅ OPTIMIZED: Increased from 768 to 900 for better field coverage
+# ✅ OPTIMIZED: Increased from 768 to 900 for better field coverage.
+# This is only a safety ceiling: JsonCompleteCriteria stops as soon as the JSON closes.
 generation_config = dict(
     max_new_tokens=900,
     do_sample=False,
@@ -32,6 +58,8 @@ DTYPE = torch.bfloat16 if (torch.cuda.is_available() and torch.cuda.get_device_c
 
 # Enable performance optimizations
 torch.backends.cudnn.benchmark = True
+if hasattr(torch.backends.cudnn, "benchmark_limit"):
+    torch.backends.cudnn.benchmark_limit = 10  # cap the per-shape autotune search
 if hasattr(torch, "set_float32_matmul_precision"):
     torch.set_float32_matmul_precision("medium")
 
@@ -40,6 +68,21 @@ torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
 
 
+# Grammar-constrained decoding: the sampler can only emit JSON matching the prompt's schema
+CONSTRAINED_JSON = os.getenv("CONSTRAINED_JSON", "1") == "1" and JsonSchemaParser is not None
+
+# Compiled vision tower is padded to a multiple of this many tiles (max_num=12 + thumbnail)
+MAX_TILES = 13
+USE_TORCH_COMPILE = os.getenv("USE_TORCH_COMPILE", "1") == "1"
+
+# InternVL exposes FlashAttention through its own `use_flash_attn` switch;
+# `attn_implementation` covers the HF-native language model path. Without FA2,
+# InternVL picks its own (eager) attention: InternVLChatModel only declares
+# _supports_flash_attn_2, so naming any other implementation fails the load.
+FLASH_ATTN_KWARGS = dict(use_flash_attn=True, attn_implementation="flash_attention_2")
+NO_FLASH_ATTN_KWARGS = dict(use_flash_attn=False)
+
+
 class ModelNotLoadedError(RuntimeError):
     pass
 
@@ -50,9 +93,182 @@ class InferenceContext:
         self.tokenizer = tokenizer
 
 
+class StaticTileEncoder(torch.nn.Module):
+    """
+    Runs the vision tower through torch.compile(mode="reduce-overhead") on a
+    multiple of MAX_TILES tiles.
+
+    Zero tiles are appended before the compiled forward and their outputs
+    dropped after, so the language model receives exactly the same image
+    tokens while the captured CUDA graphs are replayed instead of being
+    re-captured for every tile count. Padding only happens on the compiled
+    path: in eager mode (or after a compile failure) the encoder sees the
+    real tiles, so fewer-tile pages and the OOM fallback keep their savings.
+    """
+
+    def __init__(self, encoder, tile_multiple=MAX_TILES):
+        super().__init__()
+        self.encoder = encoder
+        self.tile_multiple = tile_multiple
+        self.compiled = torch.compile(encoder, mode="reduce-overhead", dynamic=False)
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self.encoder, name)
+
+    def forward(self, pixel_values, **kwargs):
+        if self.compiled is None:
+            return self.encoder(pixel_values=pixel_values, **kwargs)
+
+        n = pixel_values.shape[0]
+        padded_n = -(-n // self.tile_multiple) * self.tile_multiple
+        if padded_n != n:
+            pad = pixel_values.new_zeros((padded_n - n, *pixel_values.shape[1:]))
+            pixel_values = torch.cat([pixel_values, pad], dim=0)
+
+        try:
+            out = self.compiled(pixel_values=pixel_values, **kwargs)
+        except Exception as e:
+            print(f"⚠️ Compiled vision encoder failed, using eager mode: {e}")
+            self.compiled = None
+            return self.encoder(pixel_values=pixel_values[:n], **kwargs)
+
+        # Slice padding off (clone: CUDA graph outputs are overwritten on replay)
+        for key, value in list(out.items()):
+            if isinstance(value, torch.Tensor):
+                out[key] = value[:n].clone()
+            elif isinstance(value, tuple):
+                out[key] = tuple(v[:n].clone() for v in value)
+        return out
+
+
+class _BraceTracker:
+    """Brace depth of a streamed JSON text, ignoring braces inside strings."""
+
+    __slots__ = ("depth", "in_string", "escape", "done")
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.done = False
+
+    def feed(self, text: str) -> bool:
+        for ch in text:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}" and self.depth:
+                self.depth -= 1
+                if not self.depth:
+                    self.done = True
+                    break
+        return self.done
+
+
+class JsonCompleteCriteria(StoppingCriteria):
+    """
+    Stops each sequence as soon as its top-level JSON object is closed.
+
+    Expects `input_ids` to hold generated tokens only (InternVL generates from
+    inputs_embeds), and decodes just the tokens added since the previous step.
+    Stateful: build a new one per generate() call.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.trackers = None
+        self.seen = 0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.trackers is None:
+            self.trackers = [_BraceTracker() for _ in range(input_ids.shape[0])]
+
+        new_tokens = input_ids[:, self.seen:].tolist()
+        self.seen = input_ids.shape[1]
+
+        done = [
+            tracker.done or tracker.feed(self.tokenizer.decode(tokens, skip_special_tokens=True))
+            for tracker, tokens in zip(self.trackers, new_tokens)
+        ]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+_TOKENIZER_DATA = {}
+
+
+def _json_prefix_fn(tokenizer, prompt: str):
+    """
+    prefix_allowed_tokens_fn masking logits to JSON valid for the prompt's schema.
+    The vocabulary tables are built once per tokenizer; parser state is per call.
+    """
+    key = id(tokenizer)
+    if key not in _TOKENIZER_DATA:
+        _TOKENIZER_DATA[key] = build_token_enforcer_tokenizer_data(tokenizer)
+    parser = JsonSchemaParser(json_schema_for(prompt))
+    return build_transformers_prefix_allowed_tokens_fn(_TOKENIZER_DATA[key], parser)
+
+
+def _generation_config(tokenizer, prompt: str) -> dict:
+    """Per-call generation kwargs (the stopping criteria / JSON parser carry per-call state)."""
+    config = dict(
+        generation_config,
+        stopping_criteria=StoppingCriteriaList([JsonCompleteCriteria(tokenizer)]),
+    )
+    global CONSTRAINED_JSON
+    if CONSTRAINED_JSON:
+        try:
+            config["prefix_allowed_tokens_fn"] = _json_prefix_fn(tokenizer, prompt)
+        except Exception as e:
+            print(f"⚠️ Constrained JSON decoding disabled: {e}")
+            CONSTRAINED_JSON = False
+    return config
+
+
 _CTX = None
 
 
+def flash_attn_available() -> bool:
+    """
+    FlashAttention-2 needs an Ampere+ GPU (sm_80) and the flash_attn package.
+    """
+    if not torch.cuda.is_available() or torch.cuda.get_device_capability(0)[0] < 8:
+        return False
+    try:
+        import flash_attn  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _from_pretrained(**kwargs):
+    """
+    AutoModel.from_pretrained with FlashAttention-2 when supported, InternVL's default attention otherwise.
+    """
+    if flash_attn_available():
+        os.environ["INTERNVL_USE_FLASH_ATTN"] = "1"
+        try:
+            model = AutoModel.from_pretrained(MODEL_PATH, trust_remote_code=True, **FLASH_ATTN_KWARGS, **kwargs)
+            print("✅ Using FlashAttention-2")
+            return model
+        except Exception as e:
+            print(f"⚠️ FlashAttention-2 loading failed: {e}")
+            print("Falling back to default attention...")
+
+    os.environ["INTERNVL_USE_FLASH_ATTN"] = "0"
+    return AutoModel.from_pretrained(MODEL_PATH, trust_remote_code=True, **NO_FLASH_ATTN_KWARGS, **kwargs)
+
+
 def load_context() -> InferenceContext:
     global _CTX
 
@@ -63,6 +279,13 @@ def load_context() -> InferenceContext:
     if _CTX is not None:
         return _CTX
 
+    # Re-apply in case torch was imported (and the env read) before this module
+    if torch.cuda.is_available() and hasattr(torch.cuda.memory, "_set_allocator_settings"):
+        try:
+            torch.cuda.memory._set_allocator_settings(CUDA_ALLOC_CONF)
+        except Exception as e:
+            print(f"⚠️ Could not apply allocator settings: {e}")
+
     print("Loading tokenizer...")
     tokenizer = AutoTokenizer.from_pretrained(
         MODEL_PATH,
@@ -72,8 +295,8 @@ def load_context() -> InferenceContext:
 
     print("Loading model...")
 
-    # Tesla T4 => float16 (bf16 not supported)
-    dtype = torch.float16
+    # Tesla T4 => float16 (bf16 not supported); Ampere+ => bfloat16, matching the input tiles
+    dtype = DTYPE
 
     # -------------------------
     # 1) Try 4-bit (preferred)
@@ -86,12 +309,9 @@ def load_context() -> InferenceContext:
             bnb_4bit_quant_type="nf4",
         )
 
-        model = AutoModel.from_pretrained(
-            MODEL_PATH,
-            trust_remote_code=True,
+        model = _from_pretrained(
             quantization_config=quantization_config,
             torch_dtype=dtype,
-            use_flash_attn=False,
 
             # ✅ Avoid accelerate "auto" mapping (meta-init can break remote-code models)
             device_map={"": 0},
@@ -104,23 +324,24 @@ def load_context() -> InferenceContext:
 
     except Exception as e:
         print(f"⚠️ 4-bit loading failed: {e}")
-        print("Trying fallback: loading in float16 (no quantization)...")
+        print(f"Trying fallback: loading in {dtype} (no quantization)...")
 
         # -------------------------
-        # 2) Fallback: FP16 full load
+        # 2) Fallback: FP16/BF16 full load
         # -------------------------
-        model = AutoModel.from_pretrained(
-            MODEL_PATH,
-            trust_remote_code=True,
+        model = _from_pretrained(
             torch_dtype=dtype,
-            use_flash_attn=False,
 
             # ✅ Make sure we do NOT trigger meta init here either
             device_map=None,
             low_cpu_mem_usage=False,
         ).to("cuda").eval()
 
-        print("✅ Model loaded in float16 (no quantization)")
+        print(f"✅ Model loaded in {dtype} (no quantization)")
+
+    if USE_TORCH_COMPILE and hasattr(torch, "compile"):
+        model.vision_model = StaticTileEncoder(model.vision_model)
+        print(f"✅ Vision encoder compiled (padded to {MAX_TILES}-tile shapes)")
 
     print("✅ Using device: cuda")
     print(f"✅ Model is on: {next(model.parameters()).device}")
@@ -130,6 +351,7 @@ def load_context() -> InferenceContext:
     _CTX = InferenceContext(model=model, tokenizer=tokenizer)
     return _CTX
 
+
 def get_context() -> InferenceContext:
     """
     Safe accessor.
@@ -146,12 +368,12 @@ def internvl_chat(image_pixels, prompt: str) -> str:
     tokenizer = ctx.tokenizer
 
     try:
-        with torch.no_grad():
+        with torch.inference_mode():
             out, hist = model.chat(
                 tokenizer,
                 image_pixels,
                 prompt,
-                generation_config,
+                _generation_config(tokenizer, prompt),
                 history=None,
                 return_history=True
             )
@@ -161,11 +383,34 @@ def internvl_chat(image_pixels, prompt: str) -> str:
         raise e
 
 
-def ai_analysis(image_pixels, prompt: str):
+def internvl_batch_chat(pixel_values_list, prompt: str) -> list:
     """
-    Your exact ai_analysis logic.
+    Batched internvl_chat: one generate() call for several pages sharing the same prompt.
     """
-    resp = internvl_chat(image_pixels, prompt)
+    ctx = get_context()
+    model = ctx.model
+    tokenizer = ctx.tokenizer
+
+    num_patches_list = [pv.shape[0] for pv in pixel_values_list]
+    pixel_values = torch.cat(pixel_values_list, dim=0)
+    questions = [prompt] * len(pixel_values_list)
+
+    try:
+        with torch.inference_mode():
+            responses = model.batch_chat(
+                tokenizer,
+                pixel_values,
+                questions=questions,
+                generation_config=_generation_config(tokenizer, prompt),
+                num_patches_list=num_patches_list,
+            )
+        return responses
+    except Exception as e:
+        print(f"\n[CRITICAL ERROR] Batched inference failed on {len(pixel_values_list)} pages: {e}")
+        raise e
+
+
+def _parse_response(resp):
     if not resp:
         return None, None
     parsed, is_json = try_parse_json_strict(resp)
@@ -174,6 +419,24 @@ def ai_analysis(image_pixels, prompt: str):
     return None, resp
 
 
+def ai_analysis(image_pixels, prompt: str):
+    """
+    Your exact ai_analysis logic.
+    """
+    resp = internvl_chat(image_pixels, prompt)
+    return _parse_response(resp)
+
+
+def ai_analysis_batch(pixel_values_list, prompt: str):
+    """
+    ai_analysis over several pages at once. Returns one (parsed, raw) pair per page.
+    """
+    if len(pixel_values_list) == 1:
+        return [ai_analysis(pixel_values_list[0], prompt)]
+    responses = internvl_batch_chat(pixel_values_list, prompt)
+    return [_parse_response(resp) for resp in responses]
+
+
 def clear_gpu():
     """
     Helper to clear GPU memory if needed.
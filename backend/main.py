@@ -7,14 +7,11 @@ from fastapi import FastAPI, UploadFile, File, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 
-import requests
+import httpx
 from backend.inference import load_context, clear_gpu, ModelNotLoadedError
 from backend.pdf_extract import extract_pdf_multi
 
 
-# backend/main.py
-import traceback
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     disable = os.getenv("DISABLE_MODEL_LOAD", "0") == "1"
@@ -86,17 +83,21 @@ async def run_ocr(
         print(f"📡 Proxying OCR request to remote AWS GPU: {remote_url}")
         try:
             # Prepare data and files for remote request
-            pdf_bytes = await file.read()
-            remote_params = {"start_page": start_page, "end_page": end_page}
-            remote_files = {"file": (file.filename, pdf_bytes, file.content_type)}
-
-            # Forward the request (note: timeout increased for OCR)
-            response = requests.post(
-                f"{remote_url.rstrip('/')}/run-ocr",
-                params=remote_params,
-                files=remote_files,
-                timeout=600
-            )
+            remote_params = {"start_page": start_page}
+            if end_page is not None:
+                remote_params["end_page"] = end_page
+
+            # Stream the spooled upload into the multipart body instead of reading it into memory
+            await file.seek(0)
+            remote_files = {"file": (file.filename, file.file, file.content_type)}
+
+            # Forward the request without blocking the event loop (note: timeout increased for OCR)
+            async with httpx.AsyncClient(timeout=600) as client:
+                response = await client.post(
+                    f"{remote_url.rstrip('/')}/run-ocr",
+                    params=remote_params,
+                    files=remote_files
+                )
 
             # Return the remote response
             return JSONResponse(
@@ -111,22 +112,12 @@ async def run_ocr(
 
     # 2. Local/Standard processing
     try:
-        pdf_bytes = await file.read()
-
-        # Wrap bytes like your previous DummyUpload (keeps extract_pdf_multi unchanged)
-        class DummyUpload:
-            def __init__(self, b: bytes, name: str = "file.pdf"):
-                self._bytes = b
-                self.name = name
-
-            def getvalue(self):
-                return self._bytes
-
-        pdf_file = DummyUpload(pdf_bytes, name=file.filename)
+        # Starlette already spooled the upload to a temp file; pdfium reads it in place
+        await file.seek(0)
 
         # ✅ Call your actual extraction pipeline
         result = extract_pdf_multi(
-            pdf_file,
+            file.file,
             pdf_filename=file.filename,
             start_page=start_page,
             end_page=end_page
@@ -0,0 +1,72 @@
+# backend/page_cache.py
+
+"""
+Disk cache of parsed page results, keyed by a hash of the rendered page.
+
+Boilerplate pages (T&C, cover sheets) repeat within and across documents;
+a hit skips preprocessing and the whole decode.
+
+Off by default: cached entries are extracted document content (names,
+account numbers, ...) persisted on disk. Enable with OCR_CACHE=1 and point
+OCR_CACHE_DIR somewhere private; the directory is created owner-only (0700).
+Requires `diskcache`.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+from backend.inference import MODEL_PATH
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+
+CACHE_DIR = os.getenv("OCR_CACHE_DIR", "/tmp/ocr_cache")
+CACHE_ENABLED = os.getenv("OCR_CACHE", "0") == "1" and diskcache is not None
+
+_CACHE = None
+
+
+def get_cache():
+    """Shared diskcache.Cache (thread-safe), or None when caching is off."""
+    global _CACHE, CACHE_ENABLED
+    if _CACHE is None and CACHE_ENABLED:
+        try:
+            os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+            os.chmod(CACHE_DIR, 0o700)
+            _CACHE = diskcache.Cache(CACHE_DIR)
+        except Exception as e:
+            # e.g. unwritable or foreign-owned CACHE_DIR: run uncached instead of failing pages
+            print(f"⚠️ Page cache disabled: {e}")
+            CACHE_ENABLED = False
+    return _CACHE
+
+
+def page_key(pixels, prompt: str, max_num: int) -> str:
+    """Hash of the rendered page plus everything else that changes the model output."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{MODEL_PATH}|{max_num}|{pixels.shape}|".encode("utf-8"))
+    h.update(prompt.encode("utf-8"))
+    h.update(np.ascontiguousarray(pixels).data)
+    return h.hexdigest()
+
+
+def get_page(key):
+    cache = get_cache()
+    if cache is None or key is None:
+        return None
+    return cache.get(key)
+
+
+def set_page(key, parsed):
+    cache = get_cache()
+    if cache is None or key is None or parsed is None:
+        return
+    try:
+        cache.set(key, parsed)
+    except Exception as e:
+        print(f"⚠️ Page cache write failed: {e}")
@@ -1,46 +1,76 @@
 # backend/pdf_extract.py
 
 import gc
+import os
 import re
 import time
 from datetime import datetime
-from queue import Queue
-from threading import Thread
-import os
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+import numpy as np
+import pypdfium2 as pdfium
 import torch
+import torch.nn.functional as F
 from PIL import Image
-from pdf2image import convert_from_bytes
-import torchvision.transforms as T
-from torchvision.transforms.functional import InterpolationMode
+import torchvision.transforms.functional as TF
 from tqdm import tqdm
 
-from backend.inference import DEVICE, DTYPE, ai_analysis
+from backend.inference import DEVICE, DTYPE, ai_analysis, ai_analysis_batch
+from backend.page_cache import get_cache, get_page, page_key, set_page
 from backend.prompts import EXTRACTION_PROMPT, METADATA_PROMPT
 from backend.utils import normalize_extracted_data, save_json, pretty_console
 
 
 IMAGENET_MEAN = (0.485, 0.456, 0.406)
 IMAGENET_STD = (0.229, 0.224, 0.225)
+# (x / 255 - mean) / std folded into one x * scale + bias, kept on DEVICE in the model dtype
+_SCALE = (1.0 / (255.0 * torch.tensor(IMAGENET_STD))).to(device=DEVICE, dtype=DTYPE).view(1, 3, 1, 1)
+_BIAS = (-torch.tensor(IMAGENET_MEAN) / torch.tensor(IMAGENET_STD)).to(device=DEVICE, dtype=DTYPE).view(1, 3, 1, 1)
+
+# Trailing page count in "Page 1 of 10"
+_RE_TRAILING_INT = re.compile(r"(\d+)$")
+
+# ✅ OPTIMIZED: DPI=250 (balanced quality/speed, faster than 300)
+RENDER_DPI = 250
+
+# Release cached GPU blocks every N pages (empty_cache per page would stall the allocator)
+EMPTY_CACHE_EVERY = 10
+
+# Content-adaptive rendering: a 72-DPI probe's mean horizontal gray-level edge
+# strength picks (dpi, max_num), so sparse pages (covers, signature pages)
+# don't pay for 250 DPI and 13 vision tiles. Dense pages keep (RENDER_DPI, 12).
+# Off by default: the edge-score thresholds are not calibrated, so tune
+# RENDER_SPARSE_EDGE / RENDER_MEDIUM_EDGE on your own documents before enabling.
+# Sparse pages never drop below 6 tiles: at 4 a portrait Letter/A4 page becomes a
+# single 448 px tile (~40 effective DPI), too coarse for names and dates.
+ADAPTIVE_RENDER = os.getenv("ADAPTIVE_RENDER", "0") == "1"
+PROBE_DPI = 72
+RENDER_TIERS = (
+    # (edge_score below, dpi, max_num)
+    (float(os.getenv("RENDER_SPARSE_EDGE", "3.0")), 150, 6),
+    (float(os.getenv("RENDER_MEDIUM_EDGE", "8.0")), 200, 6),
+)
+
+
+def to_tiles(arr, image_size):
+    """(C, H, W) -> (rows * cols, C, S, S), row-major like the old crop loop"""
+    c, h, w = arr.shape
+    rows, cols = h // image_size, w // image_size
+    return (
+        arr.view(c, rows, image_size, cols, image_size)
+        .permute(1, 3, 0, 2, 4)
+        .reshape(-1, c, image_size, image_size)
+    )
 
-POPPLER_PATH = os.getenv("POPPLER_PATH")
-def build_transform(input_size):
-    return T.Compose([
-        T.Lambda(lambda img: img.convert("RGB") if img.mode != "RGB" else img),
-        T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
-        T.ToTensor(),
-        T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
-    ])
 
+def normalize_tiles(tiles):
+    """0-255 (N, 3, S, S) -> ImageNet-normalized DTYPE, in one op (no fp32 tiles)"""
+    return torch.addcmul(_BIAS, tiles.to(DTYPE), _SCALE)
 
-def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-    best_diff = float("inf")
-    best = (1, 1)
-    for r in target_ratios:
-        diff = abs(aspect_ratio - (r[0] / r[1]))
-        if diff < best_diff:
-            best_diff = diff
-            best = r
-    return best
+
+def resize_bicubic(x, size):
+    """(N, 3, H, W) float bicubic resize on x's device, clamped to 0-255 like PIL"""
+    return F.interpolate(x, size=size, mode="bicubic", align_corners=False, antialias=True).clamp_(0, 255)
 
 
 # ✅ OPTIMIZED: Pre-calculate for max_num up to 12 (balanced quality/speed)
@@ -58,17 +88,25 @@ TARGET_RATIOS_12 = sorted(
     key=lambda x: x[0] * x[1]
 )
 
+# Aspect ratios (w / h) of the grids above, for a vectorized closest-ratio lookup
+TARGET_RATIOS_6_ARR = np.array([i / j for i, j in TARGET_RATIOS_6])
+TARGET_RATIOS_12_ARR = np.array([i / j for i, j in TARGET_RATIOS_12])
+
 
 def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbnail=True):
-    """✅ OPTIMIZED: Default max_num=12 for better quality"""
-    ow, oh = image.size
+    """
+    ✅ OPTIMIZED: Default max_num=12 for better quality
+
+    `image` is a uint8 (3, H, W) tensor, already on DEVICE.
+    """
+    oh, ow = image.shape[-2:]
     aspect_ratio = ow / oh
 
     # Use pre-calculated ratios for common values
     if max_num == 6:
-        target_ratios = TARGET_RATIOS_6
+        target_ratios, ratios_arr = TARGET_RATIOS_6, TARGET_RATIOS_6_ARR
     elif max_num == 12:
-        target_ratios = TARGET_RATIOS_12
+        target_ratios, ratios_arr = TARGET_RATIOS_12, TARGET_RATIOS_12_ARR
     else:
         target_ratios = sorted(
             {(i, j) for n in range(min_num, max_num + 1)
@@ -76,50 +114,65 @@ def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbna
              if 1 <= i * j <= max_num},
             key=lambda x: x[0] * x[1]
         )
+        ratios_arr = np.array([i / j for i, j in target_ratios])
 
-    best = find_closest_aspect_ratio(aspect_ratio, target_ratios, ow, oh, image_size)
+    # Closest aspect ratio (first match wins on ties, like the old loop)
+    best = target_ratios[int(np.argmin(np.abs(ratios_arr - aspect_ratio)))]
     tw, th = image_size * best[0], image_size * best[1]
     blocks = best[0] * best[1]
 
-    resized = image.resize((tw, th))
-    crops = []
-    for i in range(blocks):
-        box = (
-            (i % (tw // image_size)) * image_size,
-            (i // (tw // image_size)) * image_size,
-            ((i % (tw // image_size)) + 1) * image_size,
-            ((i // (tw // image_size)) + 1) * image_size
-        )
-        crops.append(resized.crop(box))
+    x = image.unsqueeze(0).float()
+    tiles = to_tiles(resize_bicubic(x, (th, tw))[0], image_size)
 
-    if use_thumbnail and len(crops) != 1:
-        crops.append(image.resize((image_size, image_size)))
+    if use_thumbnail and blocks != 1:
+        tiles = torch.cat([tiles, resize_bicubic(x, (image_size, image_size))], dim=0)
 
-    return crops
+    return normalize_tiles(tiles)
+
+
+def upload(t):
+    """Host -> DEVICE copy from pinned memory, so non_blocking=True is truly async."""
+    if DEVICE == "cuda":
+        t = t.pin_memory()
+    return t.to(DEVICE, non_blocking=True)
 
 
 def load_image(image, input_size=448, max_num=12, use_thumbnail=True):
-    """✅ OPTIMIZED: Default max_num=12 for balanced quality/speed"""
-    if not isinstance(image, Image.Image):
-        image = Image.open(image).convert("RGB")
+    """
+    ✅ OPTIMIZED: Default max_num=12 for balanced quality/speed
+
+    `image` is an (H, W, 3) uint8 RGB array (pdfium render), a PIL image or a path.
+    Returns normalized tiles already on DEVICE in DTYPE.
+    """
+    if isinstance(image, np.ndarray):
+        # Upload the raw page once as uint8; resize/tile/normalize all happen on DEVICE
+        arr = upload(torch.from_numpy(image)).permute(2, 0, 1)
     else:
-        if image.mode != "RGB":
+        if not isinstance(image, Image.Image):
+            image = Image.open(image).convert("RGB")
+        elif image.mode != "RGB":
             image = image.convert("RGB")
-
-    transform = build_transform(input_size)
-    chunks = dynamic_preprocess(image, image_size=input_size, max_num=max_num, use_thumbnail=use_thumbnail)
-    px = torch.stack([transform(c) for c in chunks])
-    return px
+        arr = upload(TF.pil_to_tensor(image))
+    return dynamic_preprocess(arr, image_size=input_size, max_num=max_num, use_thumbnail=use_thumbnail)
 
 
 def process_single_page(image_pil, prompt, max_num=12):
     """✅ OPTIMIZED: Default max_num=12 with fallback to 6 if OOM"""
+    # Hashing a full-resolution page isn't free, so skip it when caching is off
+    cacheable = isinstance(image_pil, np.ndarray) and get_cache() is not None
+    key = page_key(image_pil, prompt, max_num) if cacheable else None
+
     try:
+        cached = get_page(key)
+        if cached is not None:
+            return {"status": "success_cached", "data": normalize_extracted_data(cached)}
+
         pv = load_image(image_pil, input_size=448, max_num=max_num, use_thumbnail=True)
-        pv = pv.to(dtype=DTYPE, device=DEVICE)
         parsed, raw = ai_analysis(pv, prompt)
-        parsed = normalize_extracted_data(parsed)
-        return {"status": "success", "data": parsed}
+        data = normalize_extracted_data(parsed)
+        # Cache only output that normalized cleanly, so a bad parse can't poison later runs
+        set_page(key, parsed)
+        return {"status": "success", "data": data}
 
     except RuntimeError as e:
         if "CUDA" in str(e) or "out of memory" in str(e).lower():
@@ -127,7 +180,6 @@ def process_single_page(image_pil, prompt, max_num=12):
             gc.collect()
             # Fallback to fewer tiles
             pv = load_image(image_pil, input_size=448, max_num=6, use_thumbnail=True)
-            pv = pv.to(dtype=DTYPE, device=DEVICE)
             parsed, raw = ai_analysis(pv, prompt)
             parsed = normalize_extracted_data(parsed)
             return {"status": "success_fallback", "data": parsed}
@@ -138,24 +190,104 @@ def process_single_page(image_pil, prompt, max_num=12):
         return {"status": "error", "data": {"section": "ERROR", "error_message": str(e)}}
 
 
+def open_pdf(pdf_file):
+    """
+    Open a pdfium document from bytes, a path, or a seekable file-like object
+    (read in place when it supports readinto(), else read into bytes). Objects that only offer
+    getvalue() (e.g. Streamlit uploads) are opened from their bytes.
+    """
+    if isinstance(pdf_file, (bytes, str, os.PathLike)):
+        pdf = pdfium.PdfDocument(pdf_file)
+    elif hasattr(pdf_file, "read") and hasattr(pdf_file, "seek"):
+        pdf_file.seek(0)
+        # pdfium reads buffers through readinto(), which SpooledTemporaryFile
+        # (FastAPI's UploadFile.file) only has on Python 3.11+
+        pdf = pdfium.PdfDocument(pdf_file if hasattr(pdf_file, "readinto") else pdf_file.read())
+    else:
+        pdf = pdfium.PdfDocument(pdf_file.getvalue())
+    # Must run before any page is loaded, or filled-in AcroForm fields don't render
+    pdf.init_forms()
+    return pdf
+
+
+def render_page(pdf, page_no, dpi=RENDER_DPI, **render_kwargs):
+    """
+    Rasterize a single (1-indexed) page in-process with pdfium.
+
+    Returns the PdfBitmap; `.to_numpy()` is an (H, W, 3) RGB view of its
+    buffer, so keep the bitmap alive until the pixels are uploaded.
+    """
+    page = pdf[page_no - 1]
+    try:
+        return page.render(scale=dpi / 72, rev_byteorder=True, **render_kwargs)
+    finally:
+        page.close()
+
+
+def choose_render_settings(pdf, page_no):
+    """(dpi, max_num) for a page, from the text density of a cheap 72-DPI probe."""
+    if not ADAPTIVE_RENDER:
+        return RENDER_DPI, 12
+
+    probe = render_page(pdf, page_no, dpi=PROBE_DPI, grayscale=True)
+    gray = probe.to_numpy().reshape(probe.height, probe.width).astype(np.int16)
+    edge_score = float(np.abs(np.diff(gray, axis=1)).mean())
+
+    for threshold, dpi, max_num in RENDER_TIERS:
+        if edge_score < threshold:
+            return dpi, max_num
+    return RENDER_DPI, 12
+
+
+def _error_page(page_idx, message):
+    return {"page": page_idx, "section": "ERROR", "error_message": message}
+
+
+def _build_page_data(page_idx, parsed, raw):
+    if parsed is None:
+        return _error_page(page_idx, f"Invalid JSON. Raw: {raw[:200] if raw else 'None'}")
+
+    parsed = normalize_extracted_data(parsed)
+
+    page_data = {
+        "page": page_idx,
+        "section": parsed.get("section", "UNKNOWN SECTION")
+    }
+    for key, value in parsed.items():
+        if key != "section" and value:
+            page_data[key] = value
+    return page_data
+
+
+def _finish_page(page_idx, parsed, raw, key=None):
+    """_build_page_data that never raises; the parse is cached only once it normalizes cleanly."""
+    try:
+        page_data = _build_page_data(page_idx, parsed, raw)
+    except Exception as e:
+        print(f"❌ Post-processing error page {page_idx}: {e}")
+        return _error_page(page_idx, f"Post-processing failed: {e}")
+    set_page(key, parsed)
+    return page_data
+
+
 def extract_pdf_multi(
     pdf_file,
     pdf_filename="unknown",
     start_page=1,
     end_page=None,  # ✅ NEW: Use end_page instead of max_pages
     prompt=EXTRACTION_PROMPT,
-    batch_size=1
+    batch_size=4
 ):
     """
     ✅ OPTIMIZED: Now supports flexible page ranges
 
     Args:
-        pdf_file: PDF file object with getvalue() method
+        pdf_file: PDF as bytes, a path, a file-like object, or an object with getvalue()
         pdf_filename: Name of the PDF file
         start_page: Starting page number (1-indexed)
         end_page: Ending page number (1-indexed, None = all pages)
         prompt: Extraction prompt
-        batch_size: Always 1 for sequential processing
+        batch_size: Pages per batched generate() call
 
     Examples:
         extract_pdf_multi(pdf, start_page=1, end_page=5)  # Pages 1-5
@@ -164,124 +296,193 @@ def extract_pdf_multi(
     """
     t0 = time.time()
 
-    # Calculate page range for conversion
-    first_p = start_page
-    last_p = end_page
-
-    # ✅ OPTIMIZED: DPI=250 (balanced quality/speed, faster than 300)
-    images = convert_from_bytes(
-        pdf_file.getvalue(),
-        dpi=250,  # Increased from 200 for better OCR
-        first_page=first_p,
-        last_page=last_p,
-        thread_count=4,
-        fmt="png",
-        grayscale=False,
-        size=None,
-        poppler_path=POPPLER_PATH
-    )
+    pdf = open_pdf(pdf_file)
+    try:
+        doc_pages = len(pdf)
 
-    total = len(images)
-    pages = images
+        # Calculate page range for conversion
+        first_p = start_page
+        last_p = min(end_page or doc_pages, doc_pages)
+        if first_p > last_p:
+            raise ValueError(f"start_page {first_p} is beyond the last page ({doc_pages})")
 
-    print(f"📄 PDF converted: {total} pages (Range: {first_p} to {last_p or 'end'})")
+        total = last_p - first_p + 1
 
-    # Process metadata from first page
-    print("📋 Extracting metadata...")
-    metadata_start = time.time()
-    first_page_img = images[0]
-    metadata_res = process_single_page(first_page_img, METADATA_PROMPT, max_num=12)
-    metadata = metadata_res["data"]
-    metadata_time = time.time() - metadata_start
-    print(f"✅ Metadata extracted in {metadata_time:.2f}s")
+        print(f"📄 PDF opened: {total} pages (Range: {first_p} to {last_p})")
 
-    doc_type = metadata.get("document_type") or "unknown"
-    envelope_id = metadata.get("envelope_id")
-    total_pages_in_doc = metadata.get("total_pages_in_doc")
+        first_page_bitmap = render_page(pdf, first_p)
 
-    if total_pages_in_doc and isinstance(total_pages_in_doc, str):
-        try:
-            # Extract number from "Page 1 of 10" format
-            match = re.search(r"(\d+)$", total_pages_in_doc)
-            if match:
-                total_pages_in_doc = int(match.group(1))
-            else:
-                total_pages_in_doc = int(total_pages_in_doc)
-        except Exception:
-            total_pages_in_doc = total
+        # pdfium is not thread-safe, not even across objects: once the worker starts,
+        # only it may touch (or free) pdfium objects. The metadata pass gets its own
+        # copy of the pixels and the worker owns, and frees, the first bitmap.
+        first_page_pixels = first_page_bitmap.to_numpy().copy()
 
-    page_results = []
+        # The pipeline reuses the already-rendered first page instead of re-rendering it
+        rendered = {first_p: first_page_bitmap}
+        del first_page_bitmap
 
-    print(f"🚀 Processing {len(pages)} pages...")
+        # ✅ OPTIMIZED: Streamed render -> preprocess pipeline with a bounded Queue,
+        # so only a few pages are held in RAM while the GPU works on earlier ones
+        preprocessed_queue = Queue(maxsize=2 * batch_size)
 
-    # ✅ OPTIMIZED: Pipelined preprocessing with Queue
-    preprocessed_queue = Queue(maxsize=2)
+        # Uploads + preprocessing kernels run on a side stream so they overlap with decoding
+        upload_stream = torch.cuda.Stream() if DEVICE == "cuda" else None
 
-    def preprocessor_worker():
-        for page_idx, img in enumerate(pages, start=start_page):
-            try:
-                # Preprocess with max_num=12 for quality
-                pv = load_image(img, input_size=448, max_num=12, use_thumbnail=True)
-                pv = pv.to(dtype=DTYPE, device=DEVICE, non_blocking=True)
-                preprocessed_queue.put((page_idx, pv))
-            except Exception as e:
-                print(f"⚠ Preprocessor error page {page_idx}: {e}")
-                preprocessed_queue.put((page_idx, None))
-
-    # Start preprocessor thread
-    prepro_thread = Thread(target=preprocessor_worker, daemon=True)
-    prepro_thread.start()
-
-    # Process pages sequentially for GPU efficiency
-    with tqdm(total=len(pages), desc="Extracting", unit="pg") as pbar:
-        for _ in range(len(pages)):
-            page_start = time.time()
-            inference_time = 0.0
-
-            page_idx, pv = preprocessed_queue.get()
-
-            if pv is None:
-                page_data = {
-                    "page": page_idx,
-                    "section": "ERROR",
-                    "error_message": "Preprocessing failed"
-                }
-            else:
-                try:
-                    inference_start = time.time()
-                    parsed, raw = ai_analysis(pv, prompt)
-                    inference_time = time.time() - inference_start
+        # Set when the consumer exits (normally or on an exception) so the worker stops
+        # rendering instead of blocking forever on a full queue
+        stop = Event()
 
-                    if parsed is None:
-                        page_data = {
-                            "page": page_idx,
-                            "section": "ERROR",
-                            "error_message": f"Invalid JSON. Raw: {raw[:200] if raw else 'None'}"
-                        }
+        def put(item):
+            while not stop.is_set():
+                try:
+                    preprocessed_queue.put(item, timeout=0.1)
+                    return
+                except Full:
+                    continue
+
+        def pipeline_worker():
+            for page_idx in range(first_p, last_p + 1):
+                if stop.is_set():
+                    break
+                bitmap = pixels = None
+                try:
+                    if page_idx in rendered:
+                        # First page: already rendered at full quality for the metadata pass
+                        bitmap, max_num = rendered.pop(page_idx), 12
                     else:
-                        parsed = normalize_extracted_data(parsed)
+                        dpi, max_num = choose_render_settings(pdf, page_idx)
+                        bitmap = render_page(pdf, page_idx, dpi=dpi)
+                    pixels = bitmap.to_numpy()
+
+                    # Identical page seen before (boilerplate): skip preprocessing and inference
+                    key = page_key(pixels, prompt, max_num) if get_cache() is not None else None
+                    cached = get_page(key)
+                    if cached is not None:
+                        put((page_idx, None, None, key, cached))
+                        continue
+
+                    with torch.cuda.stream(upload_stream):
+                        pv = load_image(pixels, input_size=448, max_num=max_num, use_thumbnail=True)
+                    uploaded = None
+                    if upload_stream is not None:
+                        uploaded = torch.cuda.Event()
+                        uploaded.record(upload_stream)
+                    put((page_idx, pv, uploaded, key, None))
+                except Exception as e:
+                    print(f"⚠ Preprocessor error page {page_idx}: {e}")
+                    put((page_idx, None, None, None, None))
+                finally:
+                    # Drop the rendered page as soon as its tensor exists
+                    bitmap = pixels = None
+
+        # Start render/preprocess thread
+        pipeline_thread = Thread(target=pipeline_worker, daemon=True)
+        pipeline_thread.start()
+    except BaseException:
+        # No worker yet, so the finally below that closes pdf won't run
+        pdf.close()
+        raise
 
-                        page_data = {
-                            "page": page_idx,
-                            "section": parsed.get("section", "UNKNOWN SECTION")
-                        }
-                        for key, value in parsed.items():
-                            if key != "section" and value:
-                                page_data[key] = value
+    try:
+        # Process metadata from first page (pages 2+ render in the background meanwhile)
+        print("📋 Extracting metadata...")
+        metadata_start = time.time()
+        metadata_res = process_single_page(first_page_pixels, METADATA_PROMPT, max_num=12)
+        del first_page_pixels
+        metadata = metadata_res["data"]
+        metadata_time = time.time() - metadata_start
+        print(f"✅ Metadata extracted in {metadata_time:.2f}s")
+
+        doc_type = metadata.get("document_type") or "unknown"
+        envelope_id = metadata.get("envelope_id")
+        total_pages_in_doc = metadata.get("total_pages_in_doc")
+
+        if total_pages_in_doc and isinstance(total_pages_in_doc, str):
+            try:
+                # Extract number from "Page 1 of 10" format
+                match = _RE_TRAILING_INT.search(total_pages_in_doc)
+                if match:
+                    total_pages_in_doc = int(match.group(1))
+                else:
+                    total_pages_in_doc = int(total_pages_in_doc)
+            except Exception:
+                total_pages_in_doc = total
+
+        page_results = []
+
+        print(f"🚀 Processing {total} pages...")
+
+        # Process pages in batches for GPU efficiency
+        with tqdm(total=total, desc="Extracting", unit="pg") as pbar, torch.inference_mode():
+            remaining = total
+            since_flush = 0
+            while remaining:
+                batch_start = time.time()
+                inference_time = 0.0
+
+                batch = [preprocessed_queue.get() for _ in range(min(batch_size, remaining))]
+                remaining -= len(batch)
+
+                ready = []
+                for page_idx, pv, uploaded, key, cached in batch:
+                    if cached is not None:
+                        page_results.append(_finish_page(page_idx, cached, None))
+                        continue
+                    if pv is None:
+                        page_results.append(_error_page(page_idx, "Preprocessing failed"))
+                        continue
+                    if uploaded is not None:
+                        # Order this page's side-stream work before the model consumes it
+                        torch.cuda.current_stream().wait_event(uploaded)
+                        pv.record_stream(torch.cuda.current_stream())
+                    ready.append((page_idx, pv, key))
+
+                if ready:
+                    inference_start = time.time()
+                    # Only generation failures trigger the per-page retry;
+                    # post-processing errors are handled page by page in _finish_page
+                    try:
+                        outputs = ai_analysis_batch([pv for _, pv, _ in ready], prompt)
+                    except Exception as e:
+                        # e.g. OOM on the batched call: retry the pages one by one
+                        print(f"⚠ Batch of {len(ready)} pages failed ({e}), retrying individually")
+                        torch.cuda.empty_cache()
+                        outputs = []
+                        for page_idx, pv, _ in ready:
+                            try:
+                                outputs.append(ai_analysis(pv, prompt))
+                            except Exception as e:
+                                print(f"❌ Error page {page_idx}: {e}")
+                                outputs.append(e)
+                    inference_time = time.time() - inference_start
 
-                except Exception as e:
-                    print(f"❌ Error page {page_idx}: {e}")
-                    page_data = {
-                        "page": page_idx,
-                        "section": "ERROR",
-                        "error_message": str(e)
-                    }
-
-            page_results.append(page_data)
-
-            page_time = time.time() - page_start
-            pbar.set_postfix({"inf": f"{inference_time:.1f}s", "tot": f"{page_time:.1f}s"})
-            pbar.update(1)
+                    for (page_idx, _, key), output in zip(ready, outputs):
+                        if isinstance(output, Exception):
+                            page_results.append(_error_page(page_idx, str(output)))
+                        else:
+                            parsed, raw = output
+                            page_results.append(_finish_page(page_idx, parsed, raw, key))
+
+                batch_time = time.time() - batch_start
+                pbar.set_postfix({"inf": f"{inference_time:.1f}s", "tot": f"{batch_time:.1f}s"})
+                pbar.update(len(batch))
+
+                # Drop this batch's page tensors before waiting on the next one
+                since_flush += len(batch)
+                batch = ready = pv = None
+                if since_flush >= EMPTY_CACHE_EVERY:
+                    torch.cuda.empty_cache()
+                    since_flush = 0
+    finally:
+        stop.set()
+        # Unblock a worker waiting on put() and release any queued page tensors
+        try:
+            while True:
+                preprocessed_queue.get_nowait()
+        except Empty:
+            pass
+        pipeline_thread.join()
+        pdf.close()
 
     page_results.sort(key=lambda x: x["page"])
 
@@ -0,0 +1,45 @@
+# backend/schemas.py
+
+"""
+Pydantic shapes of the JSON the prompts in backend/prompts.py ask for.
+Used to constrain decoding so the model can only emit valid JSON.
+"""
+
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from backend.prompts import EXTRACTION_PROMPT, METADATA_PROMPT
+
+
+class PageExtraction(BaseModel):
+    section: Optional[str] = None
+    form_fields: Dict[str, Any] = {}
+    tables: Dict[str, List[Dict[str, Any]]] = {}
+    checkboxes: Dict[str, str] = {}
+    signatures: Dict[str, Any] = {}
+
+
+class DocumentMetadata(BaseModel):
+    document_type: Optional[str] = None
+    envelope_id: Optional[str] = None
+    total_pages_in_doc: Optional[str] = None
+    organization: Optional[str] = None
+    form_number: Optional[str] = None
+    primary_contact: Optional[str] = None
+
+
+PROMPT_SCHEMAS = {
+    EXTRACTION_PROMPT: PageExtraction,
+    METADATA_PROMPT: DocumentMetadata,
+}
+
+
+def json_schema_for(prompt: str):
+    """JSON schema for a known prompt, or None (= any valid JSON)."""
+    model = PROMPT_SCHEMAS.get(prompt)
+    if model is None:
+        return None
+    if hasattr(model, "model_json_schema"):
+        return model.model_json_schema()
+    return model.schema()
@@ -2,18 +2,74 @@
 
 import json
 import re
+from functools import lru_cache
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def clean_model_json(text: str) -> str:
-    """Enhanced JSON cleaning"""
-    if not isinstance(text, str):
+# 19+ digit runs may be integers outside orjson's 64-bit range, which it turns into floats
+_LONG_DIGITS = re.compile(r"\d{19}")
+_LONG_DIGITS_BYTES = re.compile(rb"\d{19}")
+
+
+def _loads(data):
+    """
+    orjson.loads when it gives the same result as json.loads, json.loads otherwise:
+    orjson rejects NaN/Infinity and lone surrogate escapes, and rounds huge integers
+    (long policy/account numbers) to floats.
+    """
+    if orjson is not None:
+        long_digits = _LONG_DIGITS if isinstance(data, str) else _LONG_DIGITS_BYTES
+        if not long_digits.search(data):
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+    return json.loads(data)
+
+
+_RE_TRAILING_COMMA = re.compile(r",\s*[}\]]")
+
+
+def _strip_trailing_commas(text: str) -> str:
+    """Drop commas directly before } or ], skipping anything inside string literals."""
+    # ✅ OPTIMIZED: the regex finds the (usually zero) candidates and str.count's quote
+    # parity decides whether each sits inside a string; no per-character Python loop
+    candidates = [m.start() for m in _RE_TRAILING_COMMA.finditer(text)]
+    if not candidates:
         return text
+    # Blank out escaped backslashes (same length, offsets unchanged) so that
+    # every remaining \" is an escaped quote
+    scan = text.replace("\\\\", "  ") if "\\\\" in text else text
+
+    parts = []
+    start = last = quotes = 0
+    for pos in candidates:
+        quotes += scan.count('"', last, pos) - scan.count('\\"', last, pos)
+        last = pos
+        if not quotes % 2:
+            parts.append(text[start:pos])
+            start = pos + 1
+    if not parts:
+        return text
+    parts.append(text[start:])
+    return "".join(parts)
+
+
+def _clean_model_json(text: str) -> str:
     cleaned = text.strip()
 
     # Remove markdown code blocks
-    cleaned = re.sub(r"^```(?:json)?\s*", "", cleaned, flags=re.IGNORECASE | re.MULTILINE)
-    cleaned = re.sub(r"\s*```$", "", cleaned, flags=re.MULTILINE)
-    cleaned = cleaned.replace("```", "")
+    if cleaned.startswith("```"):
+        # Strip only the fence token (``` plus an optional json tag): the JSON may start on the same line
+        cleaned = cleaned[3:]
+        if cleaned[:4].lower() == "json":
+            cleaned = cleaned[4:]
+        cleaned = cleaned.lstrip()
+    if cleaned.endswith("```"):
+        cleaned = cleaned[:-3]
 
     # Extract JSON object
     first = cleaned.find("{")
@@ -22,49 +78,164 @@ def clean_model_json(text: str) -> str:
         cleaned = cleaned[first:last + 1]
 
     # Fix common JSON errors (trailing commas)
-    cleaned = re.sub(r",\s*([}\]])", r"\1", cleaned)
+    cleaned = _strip_trailing_commas(cleaned)
 
     return cleaned.strip()
 
 
+# Repeated boilerplate pages produce identical responses; only short texts are
+# memoized so the cache never pins large outputs in memory.
+CLEAN_CACHE_MAX_CHARS = 32768
+_clean_model_json_cached = lru_cache(maxsize=256)(_clean_model_json)
+
+
+def clean_model_json(text: str) -> str:
+    """Enhanced JSON cleaning"""
+    if not isinstance(text, str):
+        return text
+    if len(text) >= CLEAN_CACHE_MAX_CHARS:
+        return _clean_model_json(text)
+    return _clean_model_json_cached(text)
+
+
 def try_parse_json_strict(obj):
     if isinstance(obj, dict):
         return obj, True
+    if isinstance(obj, (bytes, bytearray)):
+        try:
+            parsed = _loads(obj)
+            if isinstance(parsed, dict):
+                return parsed, True
+        except Exception:
+            pass
+        obj = bytes(obj).decode("utf-8", "replace")
     if isinstance(obj, str):
+        # ✅ OPTIMIZED: constrained decoding usually yields clean JSON; skip cleanup when it parses as-is
+        if obj.startswith("{"):
+            try:
+                parsed = _loads(obj)
+                if isinstance(parsed, dict):
+                    return parsed, True
+            except Exception:
+                pass
         cleaned = clean_model_json(obj)
         try:
-            parsed = json.loads(cleaned)
+            parsed = _loads(cleaned)
             return parsed, True
         except Exception:
             return obj, False
     return obj, False
 
 
+# Values dropped by remove_empty_values ("N/A", 0 and False are kept)
+_EMPTY_SENTINELS = (None, "", [], {})
+
+
+def _keep(v):
+    # ✅ OPTIMIZED: identity/type checks first; bool() replaces the container == comparisons
+    if v is None:
+        return False
+    if v is False or v is True:
+        return True
+    t = type(v)
+    if t is str or t is dict or t is list:
+        return bool(v)
+    if t is int or t is float:
+        return True
+    return v not in _EMPTY_SENTINELS
+
+
+# _clean_dict/_clean_list inline _keep's str/dict/list cases: they are almost every value
+
+def _clean_dict(data):
+    # ✅ OPTIMIZED: only copy once the first value is dropped or replaced
+    cleaned = None
+    for k, v in data.items():
+        t = type(v)
+        if t is str:
+            keep = v != ""
+            new = v
+        elif t is dict or t is list:
+            keep = bool(v)
+            new = _CLEANERS[t](v) if keep else v
+        else:
+            keep = _keep(v)
+            new = v
+        if cleaned is None:
+            if keep and new is v:
+                continue
+            # Everything before k was kept unchanged
+            cleaned = {}
+            for pk, pv in data.items():
+                if pk == k:
+                    break
+                cleaned[pk] = pv
+        if keep:
+            cleaned[k] = new
+    return data if cleaned is None else cleaned
+
+
+def _clean_list(data):
+    # ✅ OPTIMIZED: only copy once the first element is dropped or replaced
+    cleaned = None
+    for i, item in enumerate(data):
+        t = type(item)
+        if t is str:
+            keep = item != ""
+            new = item
+        elif t is dict or t is list:
+            keep = bool(item)
+            new = _CLEANERS[t](item) if keep else item
+        else:
+            keep = _keep(item)
+            new = item
+        if cleaned is None:
+            if keep and new is item:
+                continue
+            cleaned = data[:i]
+        if keep:
+            cleaned.append(new)
+    if cleaned is None:
+        cleaned = data
+    return cleaned if cleaned else None
+
+
+# Keyed on exact type: parsed JSON only ever contains plain dicts and lists
+_CLEANERS = {dict: _clean_dict, list: _clean_list}
+
+
 def remove_empty_values(data):
     """Smart removal that preserves explicit values like 'N/A'"""
-    if isinstance(data, dict):
-        return {
-            k: remove_empty_values(v)
-            for k, v in data.items()
-            if (v is not None and v != "" and v != [] and v != {})
-            or v == "N/A"
-            or v == 0
-            or v is False
-        }
-    elif isinstance(data, list):
-        cleaned = [
-            remove_empty_values(item)
-            for item in data
-            if item is not None and item != "" and item != {} and item != []
-        ]
-        return cleaned if cleaned else None
-    else:
-        return data
+    clean = _CLEANERS.get(type(data))
+    return data if clean is None else clean(data)
+
+
+def _dumps_pretty(obj) -> str:
+    """Indented JSON text; orjson when available, stdlib for anything it can't encode."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj, indent=2, ensure_ascii=False)
+
+
+def _dumps_pretty_head(obj, max_chars: int) -> str:
+    """First max_chars + 1 characters of the indented JSON, without encoding the rest."""
+    parts = []
+    total = 0
+    for chunk in json.JSONEncoder(indent=2, ensure_ascii=False).iterencode(obj):
+        parts.append(chunk)
+        total += len(chunk)
+        if total > max_chars:
+            break
+    return "".join(parts)
 
 
 def pretty_console(obj, max_chars=None):
     if isinstance(obj, dict):
-        s = json.dumps(obj, indent=2, ensure_ascii=False)
+        # ✅ OPTIMIZED: a truncated preview only encodes what it prints
+        s = _dumps_pretty_head(obj, max_chars) if max_chars else _dumps_pretty(obj)
     else:
         s = str(obj)
     if max_chars and len(s) > max_chars:
@@ -73,8 +244,18 @@ def pretty_console(obj, max_chars=None):
 
 
 def save_json(path: str, data: dict):
+    # ✅ OPTIMIZED: encode once and write once (json.dump issues a write() per token)
+    if orjson is not None:
+        try:
+            payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+        except TypeError:
+            payload = None
+        if payload is not None:
+            with open(path, "wb") as f:
+                f.write(payload)
+            return
     with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.write(json.dumps(data, indent=2, ensure_ascii=False))
 
 
 def normalize_extracted_data(parsed):
@@ -93,31 +274,26 @@ def normalize_extracted_data(parsed):
 
         # Handle tables as list or dict
         if isinstance(tables, list):
-            merged = {}
-            for t in tables:
-                if isinstance(t, dict):
-                    merged.update(t)
-            tables = merged
+            tables = {k: v for t in tables if isinstance(t, dict) for k, v in t.items()}
             parsed["tables"] = tables
 
         if isinstance(tables, dict):
-            table_fields = set()
-            for table_name, table_data in tables.items():
-                if isinstance(table_data, list) and table_data:
-                    first_row = table_data[0]
-                    if isinstance(first_row, dict):
-                        table_fields.update(first_row.keys())
+            # ✅ OPTIMIZED: one pass over form_fields, no intermediate removal list
+            table_fields = frozenset().union(*(
+                rows[0].keys()
+                for rows in tables.values()
+                if isinstance(rows, list) and rows and isinstance(rows[0], dict)
+            ))
 
             # Remove duplicate fields
-            fields_to_remove = []
-            for field_name, field_value in parsed.get("form_fields", {}).items():
-                if field_name in table_fields and isinstance(field_value, list):
-                    fields_to_remove.append(field_name)
-
-            for field_name in fields_to_remove:
-                del parsed["form_fields"][field_name]
-
-            if not parsed["form_fields"]:
+            form_fields = {
+                k: v
+                for k, v in parsed["form_fields"].items()
+                if not (k in table_fields and isinstance(v, list))
+            }
+            if form_fields:
+                parsed["form_fields"] = form_fields
+            else:
                 del parsed["form_fields"]
 
     return remove_empty_values(parsed)
\ No newline at end of file
@@ -1,12 +1,93 @@
 import os
+import pandas as pd
 import streamlit as st
 import requests
 import json
+import re
+import uuid
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 19+ digit runs may be integers outside orjson's 64-bit range, which it turns into floats
+_LONG_DIGITS = re.compile(rb"\d{19}")
+
 BASE_BACKEND_URL = os.getenv("BASE_BACKEND_URL", "http://13.60.77.224:8000")
 FASTAPI_URL = f"{BASE_BACKEND_URL}/run-ocr"
 
+
+# ---------------------------
+# CACHED HELPERS
+# ---------------------------
+# ✅ OPTIMIZED: probe /health at most every 10s instead of on every rerun
+@st.cache_data(ttl=10, show_spinner=False)
+def _ping_backend(url):
+    """Status code of GET /health, or None when the backend is unreachable."""
+    try:
+        return requests.get(f"{url}/health", timeout=3).status_code
+    except Exception:
+        return None
+
+
+# The extraction result lives in session_state as the raw response bytes; the decoded
+# dict is shared per result_id (cache_resource hands back the same object, no copy).
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _decode_result(result_id, _blob):
+    # stdlib json for what orjson rejects (NaN, lone surrogates) or would round (huge ints)
+    if orjson is not None and not _LONG_DIGITS.search(_blob):
+        try:
+            return orjson.loads(_blob)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(_blob)
+
+
+# Keyed on the result's id (a fresh uuid per extraction) rather than hashing the
+# whole payload; underscore args are skipped by st.cache_data's hasher.
+@st.cache_data(show_spinner=False, max_entries=8)
+def _render_json(result_id, _result):
+    if orjson is not None:
+        try:
+            return orjson.dumps(_result, option=orjson.OPT_INDENT_2).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(_result, indent=2, ensure_ascii=False)
+
+
+# Above this response size the Raw JSON tab shows a trimmed tree; Export keeps the full output
+PREVIEW_MAX_BYTES = 200_000
+PREVIEW_MAX_ITEMS = 50
+
+
+def _truncate_for_preview(obj, max_items=PREVIEW_MAX_ITEMS):
+    """Copy of obj with every list cut to max_items entries plus a marker."""
+    if isinstance(obj, dict):
+        return {k: _truncate_for_preview(v, max_items) for k, v in obj.items()}
+    if isinstance(obj, list):
+        head = [_truncate_for_preview(v, max_items) for v in obj[:max_items]]
+        if len(obj) > max_items:
+            head.append(f"... truncated {len(obj) - max_items} more")
+        return head
+    return obj
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _preview(result_id, _result):
+    return _truncate_for_preview(_result)
+
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def _table_df(result_id, page_num, table_name, _rows):
+    # from_records skips the generic constructor's input-type probing, but only
+    # list-of-dict rows are safe with it (strings would be split into characters)
+    if _rows and isinstance(_rows[0], dict):
+        return pd.DataFrame.from_records(_rows)
+    return pd.DataFrame(_rows)
+
+
 # ---------------------------
 # PAGE CONFIG
 # ---------------------------
@@ -206,13 +287,12 @@ with st.sidebar:
     st.markdown("### Backend Status")
     st.caption(f"Backend: {BASE_BACKEND_URL}")
 
-    try:
-        ping = requests.get(f"{BASE_BACKEND_URL}/health", timeout=3)
-        if ping.status_code == 200:
-            st.success("✅ Backend is running")
-        else:
-            st.warning("⚠️ Backend responded with an issue")
-    except:
+    status = _ping_backend(BASE_BACKEND_URL)
+    if status == 200:
+        st.success("✅ Backend is running")
+    elif status is not None:
+        st.warning("⚠️ Backend responded with an issue")
+    else:
         st.error("❌ Backend is not running")
 
 # ---------------------------
@@ -248,8 +328,9 @@ with right:
 # ---------------------------
 # EXTRACTION
 # ---------------------------
-if "result" not in st.session_state:
-    st.session_state.result = None
+if "result_bytes" not in st.session_state:
+    st.session_state.result_bytes = None
+    st.session_state.result_id = None
 
 if run_btn and uploaded:
     # ✅ NEW: Build URL with page parameters
@@ -257,15 +338,20 @@ if run_btn and uploaded:
     if end_page is not None:
         params["end_page"] = end_page
     
-    files = {"file": (uploaded.name, uploaded.getvalue(), "application/pdf")}
+    # ✅ OPTIMIZED: hand requests the UploadedFile itself instead of a getvalue() copy
+    uploaded.seek(0)
+    files = {"file": (uploaded.name, uploaded, "application/pdf")}
     
     with st.spinner(f"🔄 Running extraction on pages {start_page}-{end_page or 'end'}..."):
         try:
             # ✅ NEW: Pass params to backend
-            res = requests.post(FASTAPI_URL, files=files, params=params, timeout=600)
+            res = requests.post(FASTAPI_URL, files=files, params=params, timeout=600, stream=True)
 
             if res.status_code == 200:
-                st.session_state.result = res.json()
+                result_id = uuid.uuid4().hex
+                _decode_result(result_id, res.content)  # fail here, not at render time, on bad JSON
+                st.session_state.result_bytes = res.content
+                st.session_state.result_id = result_id
                 st.success("✅ Extraction completed successfully")
             else:
                 st.error(f"❌ Extraction failed (Status: {res.status_code})")
@@ -286,7 +372,9 @@ elif run_btn and not uploaded:
 # ---------------------------
 # RESULTS
 # ---------------------------
-result = st.session_state.result
+result_bytes = st.session_state.result_bytes
+result_id = st.session_state.result_id
+result = _decode_result(result_id, result_bytes) if result_bytes else None
 
 if result:
     st.markdown("---")
@@ -352,11 +440,11 @@ if result:
                                 st.markdown(f"**{table_name}**")
                                 if isinstance(table_data, list) and table_data:
                                     try:
-                                        import pandas as pd
-                                        df = pd.DataFrame(table_data)
-                                        st.dataframe(df, use_container_width=True)
-                                    except:
+                                        df = _table_df(result_id, page_num, table_name, table_data)
+                                    except Exception:
                                         st.json(table_data)
+                                    else:
+                                        st.dataframe(df, use_container_width=True)
                                 else:
                                     st.json(table_data)
                         
@@ -376,10 +464,19 @@ if result:
 
         with tab2:
             if show_raw_json:
-                st.json(result)
+                # ✅ OPTIMIZED: large payloads render a bounded preview instead of the whole tree
+                if len(result_bytes) > PREVIEW_MAX_BYTES:
+                    st.caption(
+                        f"Large output ({len(result_bytes) / 1024:.0f} KB): lists are trimmed to "
+                        f"{PREVIEW_MAX_ITEMS} items. Use the Export tab for the full JSON."
+                    )
+                    st.json(_preview(result_id, result))
+                else:
+                    st.json(result)
 
         with tab3:
-            json_text = json.dumps(result, indent=2, ensure_ascii=False)
+            # ✅ OPTIMIZED: encoded once per result, not on every rerun
+            json_text = _render_json(result_id, result)
             
             # ✅ IMPROVED: Better filename with page range
             if page_mode == "Custom Range":
@@ -387,9 +484,10 @@ if result:
             else:
                 filename = f"extracted_all_pages.json"
             
+            # The response body is already JSON; serve it as-is
             st.download_button(
                 "📥 Download JSON",
-                json_text,
+                result_bytes,
                 filename,
                 "application/json",
                 use_container_width=True